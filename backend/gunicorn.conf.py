@@ -0,0 +1,14 @@
+"""
+Gunicorn settings
+gevent workers yield on socket IO (the Auth0 JWKS fetch) instead of
+blocking the whole process; SQLite goes through the C sqlite3 module,
+which gevent does not patch, so queries still block the worker.
+The worker patches the stdlib before the app is imported, so api.py
+needs no monkey patching of its own
+"""
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+worker_connections = 1000
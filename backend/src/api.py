@@ -1,15 +1,46 @@
 import os
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, abort
 from sqlalchemy import exc
-import json
+import orjson
+from flask_caching import Cache
 from flask_cors import CORS
 
-from .database.models import db_drop_and_create_all, setup_db, Drink
+from .database.models import db_drop_and_create_all, setup_db, Drink, \
+    drinks_short_json, drinks_long_json, get_drink
 from .auth.auth import AuthError, requires_auth
 
 app = Flask(__name__)
+# Responses go through json_response, this only covers any remaining jsonify
+app.config['JSON_SORT_KEYS'] = False
 setup_db(app)
 CORS(app)
+# On disk, so every gunicorn worker sees the same entries and the same deletes
+# The entries are unpickled on read, so the folder must only be writable by
+# the app: it defaults to the app's own instance folder, not a shared /tmp path
+cache = Cache(app, config={
+    'CACHE_TYPE': 'FileSystemCache',
+    'CACHE_DIR': os.environ.get(
+        'CACHE_DIR',
+        os.path.join(app.instance_path, 'cache')
+    ),
+})
+
+DRINKS_CACHE_KEY = 'drinks_short'
+MAX_DRINKS_BATCH = 100
+
+ERROR_BODIES = {
+    status: orjson.dumps({
+        "success": False,
+        "error": status,
+        "message": message
+    })
+    for status, message in (
+        (400, "bad request"),
+        (404, "resource not found"),
+        (422, "unprocessable entity"),
+        (500, "internal server error"),
+    )
+}
 
 @app.after_request
 def after_request(response):
@@ -27,10 +58,53 @@ def after_request(response):
 
     return response
 
-'''
-Initialize the database
-'''
-db_drop_and_create_all()
+def valid_recipe(recipe):
+    '''
+    Whether the recipe has the shape the drink list queries rely on
+    a non empty list of {'color', 'parts', ...} objects
+    '''
+    return isinstance(recipe, list) and len(recipe) > 0 and all(
+        isinstance(part, dict) and 'color' in part and 'parts' in part
+        for part in recipe
+    )
+
+def json_response(body, status=200):
+    '''
+    Serialize the body with orjson, which returns utf-8 bytes directly
+    '''
+    return Response(
+        orjson.dumps(body),
+        status=status,
+        mimetype='application/json'
+    )
+
+def error_response(status):
+    '''
+    Error response with the body serialized once at import
+    '''
+    return Response(
+        ERROR_BODIES[status],
+        status=status,
+        mimetype='application/json'
+    )
+
+def drinks_response(drinks_json):
+    '''
+    Wrap a json array of drinks, already serialized by the database
+    '''
+    return Response(
+        '{"success": true, "drinks": %s}' % drinks_json,
+        mimetype='application/json'
+    )
+
+@app.cli.command('init-db')
+def init_db():
+    '''
+    Initialize the database
+    drops and recreates the tables, run it once with `flask init-db`
+    '''
+    db_drop_and_create_all()
+    cache.clear()
 
 ## ROUTES
 @app.route('/drinks', methods=['GET'])
@@ -39,21 +113,19 @@ def retrieve_drinks():
     Retrieve drinks
         it should be a public endpoint
         it should contain only the drink.short() data representation
+        it is cached for 60 seconds, any write to the drinks clears it
     returns
         status code 200
         json {"success": True, "drinks": drinks} where drinks is the list of drinks
         or appropriate status code indicating reason for failure
     '''
     try:
-        drinks = Drink.query.order_by(Drink.id).all()
-        drinks_formatted = [
-            drink.short() for drink in drinks
-        ]
+        drinks = cache.get(DRINKS_CACHE_KEY)
+        if drinks is None:
+            drinks = drinks_short_json()
+            cache.set(DRINKS_CACHE_KEY, drinks, timeout=60)
 
-        return jsonify({
-            'success': True,
-            'drinks': drinks_formatted,
-        })
+        return drinks_response(drinks)
     except Exception:
         abort(422)
 
@@ -72,15 +144,7 @@ def retrieve_drinks_detail(payload):
             or appropriate status code indicating reason for failure
     '''
     try:
-        drinks = Drink.query.order_by(Drink.id).all()
-        drinks_formatted = [
-            drink.long() for drink in drinks
-        ]
-
-        return jsonify({
-            'success': True,
-            'drinks': drinks_formatted,
-        })
+        return drinks_response(drinks_long_json())
     except Exception:
         abort(422)
 
@@ -92,30 +156,45 @@ def create_drink(payload):
             it should create a new row in the drinks table
             it should require the 'post:drinks' permission
             it should contain the drink.long() data representation
+            it should create every drink of a 'drinks' list at once
+                the list must hold 1 to MAX_DRINKS_BATCH drink objects
+            it should respond with a 422 error if any recipe is not a
+                non empty list of {'color', 'parts'} objects
         returns
             status code 200
-            json {"success": True, "drinks": drink}
-                where drink is an array containing only the newly created drink
+            json {"success": True, "drinks": drinks}
+                where drinks is an array containing only the newly created drinks
             or appropriate status code indicating reason for failure
     '''
-    # Get raw data
+    # Get raw data, either a single drink or a list in 'drinks'
     body = request.get_json()
-    recipe = body.get('recipe', None)
-    title = body.get('title', None)
+    items = body.get('drinks')
+    if not isinstance(items, list):
+        items = [body]
+
+    if not 0 < len(items) <= MAX_DRINKS_BATCH or not all(
+            isinstance(item, dict) and valid_recipe(item.get('recipe'))
+            for item in items
+    ):
+        abort(422)
 
     try:
-        # Create drink
-        drink = Drink(
-            title=title,
-            recipe=json.dumps(recipe),
-        )
+        # Create drinks
+        drinks = [
+            Drink(
+                title=item.get('title', None),
+                recipe=item.get('recipe', None),
+            )
+            for item in items
+        ]
 
         # Update db
-        drink.insert()
+        drinks_formatted = Drink.insert_all(drinks)
+        cache.delete(DRINKS_CACHE_KEY)
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'drinks': [drink.long()],
+            'drinks': drinks_formatted,
         })
     except Exception:
         abort(422)
@@ -127,6 +206,8 @@ def update_drink(drink_id):
         Update drinks
             it should respond with a 404 error if <drink_id> is not found
             it should update the corresponding row for <drink_id>
+            it should respond with a 422 error if the recipe is not a
+                non empty list of {'color', 'parts'} objects
             it should require the 'patch:drinks' permission
             it should contain the drink.long() data representation
         returns
@@ -137,9 +218,7 @@ def update_drink(drink_id):
     '''
     try:
         # Get drink
-        drink = Drink.query \
-            .filter(Drink.id == drink_id) \
-            .one_or_none()
+        drink = get_drink(drink_id)
 
         # Validate
         if drink is None:
@@ -152,13 +231,17 @@ def update_drink(drink_id):
         drink.title = body.get('title', drink.title)
 
         # Get and set the recipe
-        recipe = json.dumps(body.get('recipe'))
-        drink.recipe = recipe if recipe != 'null' else drink.recipe
+        recipe = body.get('recipe')
+        if recipe is not None:
+            if not valid_recipe(recipe):
+                abort(422)
+            drink.recipe = recipe
 
         # Update db
         drink.update()
+        cache.delete(DRINKS_CACHE_KEY)
 
-        return jsonify({
+        return json_response({
             'success': True,
             'drinks': [drink.long()],
         })
@@ -182,9 +265,7 @@ def remove_drink(drink_id):
     '''
     try:
         # Get drink
-        drink = Drink.query \
-            .filter(Drink.id == drink_id) \
-            .one_or_none()
+        drink = get_drink(drink_id)
 
         # Validate
         if drink is None:
@@ -192,8 +273,9 @@ def remove_drink(drink_id):
 
         # Update db
         drink.delete()
+        cache.delete(DRINKS_CACHE_KEY)
 
-        return jsonify({
+        return json_response({
             'success': True,
             'delete': drink_id
         })
@@ -202,57 +284,41 @@ def remove_drink(drink_id):
 
 
 @app.errorhandler(400)
-def bad_request():
+def bad_request(error):
     '''
     Handler for bad request
     '''
-    return jsonify({
-        "success": False,
-        "error": 400,
-        "message": "bad request"
-    }), 400
+    return error_response(400)
 
 @app.errorhandler(404)
-def not_found():
+def not_found(error):
     '''
     Handler for resource not found
     '''
-    return jsonify({
-        "success": False,
-        "error": 404,
-        "message": "resource not found"
-    }), 404
+    return error_response(404)
 
 @app.errorhandler(422)
-def unprocessable():
+def unprocessable(error):
     '''
     Handler for unprocessable entity
     '''
-    return jsonify({
-        "success": False,
-        "error": 422,
-        "message": "unprocessable entity"
-    }), 422
+    return error_response(422)
 
 @app.errorhandler(500)
-def internal_server_error():
+def internal_server_error(error):
     '''
     Handler for internal server error
     '''
-    return jsonify({
-        "success": False,
-        "error": 500,
-        "message": "internal server error"
-    }), 500
+    return error_response(500)
 
 @app.errorhandler(AuthError)
 def auth_error(exception):
     '''
     Handler for AuthError
     '''
-    return jsonify({
+    return json_response({
         "success": False,
         "error": exception.status_code,
         "code": exception.error['code'],
         "message": exception.error['description']
-    }), exception.status_code
+    }, exception.status_code)
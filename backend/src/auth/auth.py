@@ -1,20 +1,45 @@
 """
 Auth support
 """
+import hashlib
 import json
-from urllib.request import urlopen
+import re
+import time
+from threading import Lock
 from functools import wraps
+from cachetools import TTLCache
+import jwt
+import urllib3
 from flask import request, abort
-from jose import jwt
 
 
 AUTH0_DOMAIN = 'brunogarcia.eu.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'coffe-shop'
+JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+JWKS_TTL = 600
+JWKS_MIN_REFRESH = 30
+JWKS_TIMEOUT = 5
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 30
 
 BEARER = 'bearer'
 PERMISSIONS = 'permissions'
 AUTHORIZATION = 'Authorization'
+RSA_KEY_FIELDS = ('kty', 'kid', 'use', 'n', 'e')
+
+_BEARER_RE = re.compile(r'^bearer[ \t]+([A-Za-z0-9._~+/=-]+)\s*$', re.IGNORECASE)
+
+_JWKS_CACHE = {'keys': None, 'exp': 0, 'fetched': 0}
+_JWKS_LOCK = Lock()
+# Keeps the TLS connection to Auth0 alive between refreshes
+# One retry only, a cold start blocks every request until the first fetch,
+# so the wait stays under 2 * JWKS_TIMEOUT
+_JWKS_HTTP = urllib3.PoolManager(maxsize=4, retries=urllib3.Retry(1))
+
+# Verified payloads, keyed by _verified_cache_key
+_TOKEN_CACHE = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+_TOKEN_LOCK = Lock()
 
 ## AuthError Exception
 class AuthError(Exception):
@@ -47,6 +72,11 @@ def get_token_auth_header():
             'description': 'Authorization header is expected.'
         }, 401)
 
+    match = _BEARER_RE.match(auth)
+    if match is not None:
+        return match.group(1)
+
+    # Malformed header, only now work out what is wrong with it
     parts = auth.split()
     if parts[0].lower() != BEARER:
         raise AuthError({
@@ -60,15 +90,10 @@ def get_token_auth_header():
             'description': 'Token not found.'
         }, 401)
 
-    if len(parts) > 2:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization header must be bearer token.'
-        }, 401)
-
-    token = parts[1]
-
-    return token
+    raise AuthError({
+        'code': 'invalid_header',
+        'description': 'Authorization header must be bearer token.'
+    }, 401)
 
 def check_permissions(permission, payload):
     '''
@@ -101,6 +126,98 @@ def check_permissions(permission, payload):
 
     return True
 
+def _get_jwks(refresh=False):
+    '''
+    Get JWKS
+        @INPUTS
+            refresh: fetch the key set again, unless it was fetched
+                less than JWKS_MIN_REFRESH seconds ago
+
+        It should return the Auth0 json web key set
+        It should keep it in memory for JWKS_TTL seconds
+        It should not block on a refresh when a key set is already known:
+            only one thread fetches, the others keep using the old keys,
+            which are also kept if the fetch fails
+    '''
+    keys = _JWKS_CACHE['keys']
+    if not _jwks_needs_fetch(refresh):
+        return keys
+
+    # Only wait for the fetch when there is nothing to serve meanwhile
+    if not _JWKS_LOCK.acquire(blocking=keys is None):
+        return keys
+
+    try:
+        if _jwks_needs_fetch(refresh):
+            now = time.monotonic()
+            try:
+                response = _JWKS_HTTP.request(
+                    'GET', JWKS_URL, timeout=urllib3.Timeout(total=JWKS_TIMEOUT)
+                )
+                if response.status != 200:
+                    raise urllib3.exceptions.HTTPError(
+                        f'JWKS fetch failed with status {response.status}'
+                    )
+                _JWKS_CACHE['keys'] = json.loads(response.data)
+                _JWKS_CACHE['exp'] = now + JWKS_TTL
+            except Exception:
+                if keys is None:
+                    raise
+                # Keep the stale keys and try again later
+                _JWKS_CACHE['exp'] = now + JWKS_MIN_REFRESH
+            _JWKS_CACHE['fetched'] = now
+
+        return _JWKS_CACHE['keys']
+    finally:
+        _JWKS_LOCK.release()
+
+def _jwks_needs_fetch(refresh):
+    '''
+    Whether the cached key set is expired, or a refresh is due
+    '''
+    now = time.monotonic()
+    if now >= _JWKS_CACHE['exp']:
+        return True
+
+    return refresh and now - _JWKS_CACHE['fetched'] >= JWKS_MIN_REFRESH
+
+def _find_rsa_key(jwks, kid):
+    '''
+    Find the RSA key matching the key id (kid) in the key set
+    Return an empty dict when there is no match
+    '''
+    key = next((key for key in jwks['keys'] if key['kid'] == kid), None)
+    if key is None:
+        return {}
+
+    return {field: key[field] for field in RSA_KEY_FIELDS}
+
+def _verified_cache_key(token):
+    '''
+    Token cache key, a short hash so the token itself is not kept
+    '''
+    return hashlib.blake2s(token.encode(), digest_size=16).digest()
+
+def _verified_cache_get(cache_key):
+    '''
+    The cached payload of an already verified token
+    Return None on a miss or when the token has expired since
+    '''
+    with _TOKEN_LOCK:
+        payload = _TOKEN_CACHE.get(cache_key)
+
+    if payload is not None and payload.get('exp', 0) > time.time():
+        return payload
+
+    return None
+
+def _verified_cache_put(cache_key, payload):
+    '''
+    Cache the payload of a token that passed verification
+    '''
+    with _TOKEN_LOCK:
+        _TOKEN_CACHE[cache_key] = payload
+
 def verify_decode_jwt(token):
     '''
     Verify decode JWT
@@ -109,18 +226,24 @@ def verify_decode_jwt(token):
 
         it should be an Auth0 token with key id (kid)
         it should verify the token using Auth0 /.well-known/jwks.json
+            (cached for JWKS_TTL seconds, refreshed on unknown kid)
+        it should reuse the payload of a token verified in the last
+            TOKEN_CACHE_TTL seconds, as long as the token has not expired
         it should decode the payload from the token
         it should validate the claims
         return the decoded payload
 
         note:
-            urlopen has a common certificate error described here
+            the JWKS fetch can hit a common certificate error described here
             https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
     '''
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # On a cache hit the header is never parsed
+    cache_key = _verified_cache_key(token)
+    payload = _verified_cache_get(cache_key)
+    if payload is not None:
+        return payload
+
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
 
     if 'kid' not in unverified_header:
         raise AuthError({
@@ -128,34 +251,29 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = _find_rsa_key(_get_jwks(), unverified_header['kid'])
+
+    # Unknown kid: the keys may have been rotated, refresh once
+    if not rsa_key:
+        rsa_key = _find_rsa_key(_get_jwks(refresh=True), unverified_header['kid'])
+
     if rsa_key:
         try:
             payload = jwt.decode(
                 token,
-                rsa_key,
+                jwt.PyJWK(rsa_key).key,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
-            return payload
-
         except jwt.ExpiredSignatureError:
             raise AuthError({
                 'code': 'token_expired',
                 'description': 'Token expired.'
             }, 401)
 
-        except jwt.JWTClaimsError:
+        except (jwt.InvalidAudienceError, jwt.InvalidIssuerError):
             raise AuthError({
                 'code': 'invalid_claims',
                 'description': 'Incorrect claims. Please, check the audience and issuer.'
@@ -167,6 +285,10 @@ def verify_decode_jwt(token):
                 'description': 'Unable to parse authentication token.'
             }, 400)
 
+        _verified_cache_put(cache_key, payload)
+
+        return payload
+
     raise AuthError({
         'code': 'invalid_header',
         'description': 'Unable to find the appropriate key.'
@@ -181,7 +303,8 @@ def requires_auth(permission=''):
         Use the get_token_auth_header method to get the token
         Use the verify_decode_jwt method to decode the jwt
         Use the check_permissions method validate claims
-        And check the requested permission
+        And check the requested permission, if any
+            with no permission any valid token is accepted
         Return the decorator which passes the decoded payload to the decorated method
     '''
     def requires_auth_decorator(function_to_decorate):
@@ -194,7 +317,8 @@ def requires_auth(permission=''):
                 print(error)
                 abort(401)
 
-            check_permissions(permission, payload)
+            if permission:
+                check_permissions(permission, payload)
 
             if kwargs.get('drink_id'):
                 return function_to_decorate(kwargs.get('drink_id'))
@@ -1,5 +1,7 @@
 import os
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import Column, String, Integer, JSON, bindparam, text
+from sqlalchemy.ext import baked
+from sqlalchemy.pool import QueuePool
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -7,7 +9,22 @@ DATABASE_FILENAME = "database.db"
 PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE_PATH = "sqlite:///{}".format(os.path.join(PROJECT_DIR, DATABASE_FILENAME))
 
+# Keep connections open between requests instead of reconnecting each time
+# QueuePool has to be asked for explicitly, SQLite files default to NullPool
+# Kept small: SQLite has a single writer lock, extra connections only turn
+# queued writes into "database is locked" errors; sizes like
+# pool_size 20 / max_overflow 40 are meant for a server database (Postgres)
+ENGINE_OPTIONS = {
+    'poolclass': QueuePool,
+    'pool_size': 5,
+    'max_overflow': 0,
+    'pool_recycle': 1800,
+    'pool_pre_ping': False,
+    'connect_args': {'check_same_thread': False},
+}
+
 db = SQLAlchemy()
+bakery = baked.bakery()
 
 def setup_db(app):
     '''
@@ -15,6 +32,7 @@ def setup_db(app):
     '''
     app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_PATH
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = ENGINE_OPTIONS
     db.app = app
     db.init_app(app)
 
@@ -27,6 +45,27 @@ def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
 
+def drinks_short_json():
+    '''
+    the drink.short() list, serialized to a json array by the database
+    '''
+    return db.session.execute(DRINKS_SHORT_JSON).scalar()
+
+def drinks_long_json():
+    '''
+    the drink.long() list, serialized to a json array by the database
+    '''
+    return db.session.execute(DRINKS_LONG_JSON).scalar()
+
+def get_drink(drink_id):
+    '''
+    the drink with the given id, or None
+    uses a baked query, so the SELECT is only built and compiled once
+    EXAMPLE
+        drink = get_drink(1)
+    '''
+    return DRINK_BY_ID(db.session()).params(drink_id=drink_id).one_or_none()
+
 class Drink(db.Model):
     '''
     A persistent drink entity, extends the base SQLAlchemy Model
@@ -38,16 +77,16 @@ class Drink(db.Model):
     # String Title
     title = Column(String(80), unique=True)
 
-    # the ingredients blob - this stores a lazy json blob
+    # the ingredients blob - a json column, read and written as python objects
     # the required datatype is [{'color': string, 'name':string, 'parts':number}]
-    recipe = Column(String(180), nullable=False)
+    recipe = Column(JSON(none_as_null=True), nullable=False)
 
     def short(self):
         '''
         short form representation of the Drink model
+        the /drinks list is built by DRINKS_SHORT_JSON instead, keep both in sync
         '''
-        print(json.loads(self.recipe))
-        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in json.loads(self.recipe)]
+        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in self.recipe]
         return {
             'id': self.id,
             'title': self.title,
@@ -57,11 +96,12 @@ class Drink(db.Model):
     def long(self):
         '''
         long form representation of the Drink model
+        the /drinks-detail list is built by DRINKS_LONG_JSON instead, keep both in sync
         '''
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': json.loads(self.recipe)
+            'recipe': self.recipe
         }
 
     def insert(self):
@@ -76,6 +116,22 @@ class Drink(db.Model):
         db.session.add(self)
         db.session.commit()
 
+    @staticmethod
+    def insert_all(drinks):
+        '''
+        inserts several new models in a single transaction
+        returns their long form representation, built before the commit
+        expires them, so no row has to be read back
+        EXAMPLE
+            drinks = [Drink(title=title, recipe=recipe) for title, recipe in items]
+            drinks_formatted = Drink.insert_all(drinks)
+        '''
+        db.session.add_all(drinks)
+        db.session.flush()
+        drinks_formatted = [drink.long() for drink in drinks]
+        db.session.commit()
+        return drinks_formatted
+
     def delete(self):
         '''
         deletes a new model into a database
@@ -100,3 +156,39 @@ class Drink(db.Model):
 
     def __repr__(self):
         return json.dumps(self.short())
+
+
+DRINK_BY_ID = bakery(lambda session: session.query(Drink))
+DRINK_BY_ID += lambda query: query.filter(Drink.id == bindparam('drink_id'))
+
+# SQLite JSON1 aggregates, the whole list is built without loading any row in python
+# json() keeps the nested arrays as json instead of quoting them as strings
+# these mirror Drink.short() and Drink.long(), keep them in sync
+# ORDER BY id sits in the subquery because json_group_array(... ORDER BY ...)
+# needs SQLite 3.44; SQLite does not guarantee that an aggregate sees its rows
+# in subquery order, it only holds because the subquery is not flattened
+# (it has an ORDER BY and feeds an aggregate), switch to the aggregate form
+# once SQLite >= 3.44 can be required
+DRINKS_SHORT_JSON = text('''
+    SELECT json_group_array(json_object(
+        'id', d.id,
+        'title', d.title,
+        'recipe', json((
+            SELECT json_group_array(json_object(
+                'color', json_extract(r.value, '$.color'),
+                'parts', json_extract(r.value, '$.parts')
+            ))
+            FROM json_each(d.recipe) AS r
+        ))
+    ))
+    FROM (SELECT id, title, recipe FROM drink ORDER BY id) AS d
+''')
+
+DRINKS_LONG_JSON = text('''
+    SELECT json_group_array(json_object(
+        'id', d.id,
+        'title', d.title,
+        'recipe', json(d.recipe)
+    ))
+    FROM (SELECT id, title, recipe FROM drink ORDER BY id) AS d
+''')